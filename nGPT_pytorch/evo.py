@@ -120,9 +120,20 @@ def cross_over_attention(
 
     parent1_indices, parent2_indices = rand_indices[:midpoint], rand_indices[midpoint:]
 
-    cross_over_linear(parent1.to_q, parent2.to_q, parent1_indices, parent2_indices, child = child.to_q, dim = 0)
-    cross_over_linear(parent1.to_q, parent2.to_k, parent1_indices, parent2_indices, child = child.to_k, dim = 0)
-    cross_over_linear(parent1.to_q, parent2.to_v, parent1_indices, parent2_indices, child = child.to_v, dim = 0)
+    # queries, keys, values are packed, so cross over each of the three row blocks separately
+
+    crossover_qkv = []
+
+    for w1, w2 in zip(parent1.to_qkv.weight.chunk(3, dim = 0), parent2.to_qkv.weight.chunk(3, dim = 0)):
+        crossover_qkv.append(cat((w1[parent1_indices], w2[parent2_indices]), dim = 0))
+
+    # write into the underlying weight, as the parametrized weight is only recomputed from it
+
+    to_qkv = child.to_qkv
+    child_qkv_weight = to_qkv.linear.parametrizations.weight.original if to_qkv.parametrize else to_qkv.weight
+
+    child_qkv_weight.copy_(cat(crossover_qkv, dim = 0))
+
     cross_over_linear(parent1.to_out, parent2.to_out, parent1_indices, parent2_indices, child = child.to_out, dim = 1)
 
     cross_over_scale(parent1.qk_scale, parent2.qk_scale, parent1_indices, parent2_indices, child = child.qk_scale)
@@ -1,17 +1,18 @@
 from __future__ import annotations
 
 from functools import partial
+from collections import defaultdict
+from contextlib import nullcontext
 
 import torch
-from torch import nn, stack
+from torch import nn
 from torch.nn import Module, ModuleList
 import torch.nn.functional as F
 from torch.nn.utils.parametrize import register_parametrization
 
-from einops import rearrange, einsum
-from einops.layers.torch import Rearrange
+from einops import rearrange
 
-from rotary_embedding_torch import RotaryEmbedding
+from rotary_embedding_torch import RotaryEmbedding, apply_rotary_emb
 
 # constants
 
@@ -44,23 +45,106 @@ def l2norm(
     eps = None,
     groups = 1
 ):
-    if groups > 1:
-        t = t.chunk(groups, dim = dim)
-        t = stack(t)
+    # reductions in at least float32, to keep everything on the unit sphere under reduced precision
+
+    dtype = t.dtype
+    t = t.to(torch.promote_types(dtype, torch.float32))
+
+    # split the normed dimension into (groups, dim / groups) with a view, so there is no python branching or stack / cat copies for torch.compile
+
+    dim = dim % t.ndim
+    t = t.unflatten(dim, (groups, -1))
 
     if norm_eps == 0.:
-        out = F.normalize(t, dim = dim, p = 2)
+        out = F.normalize(t, dim = dim + 1, p = 2)
     else:
-        eps = default(eps, 1e-5 if t.dtype == torch.float16 else 1e-10)
-        norm = t.norm(dim = dim, keepdim = True)
+        eps = default(eps, 1e-5 if dtype == torch.float16 else 1e-10)
+        norm = t.norm(dim = dim + 1, keepdim = True)
         target_norm = norm.detach().clamp(min = 1. - norm_eps, max = 1. + norm_eps)
         divisor = norm / target_norm
         out = t / divisor.clamp(min = eps)
 
-    if groups > 1:
-        out = torch.cat([*out], dim = dim)
+    return out.flatten(dim, dim + 1).to(dtype)
 
-    return out
+def lerp_l2norm(
+    out,
+    residual,
+    scale,
+    eps = 1e-12,
+    inplace = False
+):
+    # l2norm(residual.lerp(l2norm(out), scale)) as a single pure tensor expression, so the normalize, lerp and renormalize lower to one fused kernel under torch.compile
+
+    def inv_norm(t):
+        norm = torch.linalg.vector_norm(t, dim = -1, keepdim = True, dtype = torch.promote_types(t.dtype, torch.float32))
+        return norm.clamp(min = eps).reciprocal()
+
+    # the branch output may be in reduced precision under autocast, while the residual stream stays in its own dtype
+
+    out = (out * inv_norm(out)).type_as(residual)
+
+    # without autograd, the normalized branch output is a fresh tensor that can take the lerp and renormalize in place
+
+    if inplace:
+        out = torch.lerp(residual, out, scale, out = out)
+        return out.mul_(inv_norm(out))
+
+    out = residual.lerp(out, scale)
+    return (out * inv_norm(out)).type_as(residual)
+
+def quantize_int8(t, eps = 1e-12):
+    # symmetric absmax int8 quantization, one scale per row
+
+    scale = t.abs().amax(dim = -1, keepdim = True).clamp(min = eps) / 127.
+    return (t / scale).round().to(torch.int8), scale
+
+def int_mm_supported(x, weight_int8):
+    # torch._int_mm is cuda only, and needs more than 16 rows and inner / output dimensions that are multiples of 8
+
+    dim = x.shape[-1]
+    rows = x.numel() // dim
+
+    return x.is_cuda and rows > 16 and dim % 8 == 0 and weight_int8.shape[0] % 8 == 0
+
+def int8_linear(
+    x,
+    weight_int8,
+    weight_scale
+):
+    # int8 x int8 -> int32 matmul, activations quantized per token, weight_scale is per output feature
+
+    x_int8, x_scale = quantize_int8(x)
+
+    *batch_dims, dim = x.shape
+
+    out = torch._int_mm(x_int8.reshape(-1, dim), weight_int8.t())
+
+    # rescale in place, so the int32 -> float conversion is the only full size logits allocation
+
+    out = out.reshape(*batch_dims, -1).float()
+    out = out.mul_(x_scale).mul_(weight_scale)
+
+    return out.to(x.dtype)
+
+def build_attn_mask(
+    mask,
+    causal = False
+):
+    # key padding mask (b, j) to a boolean sdpa mask (b, 1, i, j) with the causal mask folded in, as sdpa will not take is_causal together with an attn_mask
+
+    attn_mask = rearrange(mask, 'b j -> b 1 1 j')
+
+    if causal:
+        seq_len = mask.shape[-1]
+        causal_mask = torch.ones((seq_len, seq_len), device = mask.device, dtype = torch.bool).tril()
+        attn_mask = attn_mask & causal_mask
+
+    return attn_mask
+
+def get_row_all_masked_out(attn_mask):
+    # which query rows of an sdpa mask have every key masked out, (b, i, 1), for zeroing those rows after attention
+
+    return rearrange(~attn_mask.any(dim = -1), 'b 1 i -> b i 1')
 
 # scale
 
@@ -85,8 +169,18 @@ class Scale(Module):
             self.dim == other.dim
         )
 
-    def forward(self):
-        return self.scale * self.forward_scale
+    def forward(self, shape: tuple[int, ...] | None = None):
+        scale = self.scale
+
+        # the constant forward scale is what sets the effective learning rate of the parameter, so it is kept separate, but skipped when it is 1
+
+        if self.forward_scale != 1.:
+            scale = scale * self.forward_scale
+
+        if not exists(shape):
+            return scale
+
+        return scale.view(shape)
 
 # residual slerp update with learned scale
 
@@ -105,6 +199,10 @@ class Residual(Module):
         self.branch_scale = Scale(dim, init, default(scale, dim ** -0.5))
         self.l2norm = L2Norm(dim = -1, norm_eps = norm_eps, groups = groups)
 
+        # fused lerp + l2norm only for the plain unit norm, without hyperspheres
+
+        self.fused = norm_eps == 0. and groups == 1
+
     def forward(self, x, **kwargs):
         residual = x
 
@@ -115,8 +213,16 @@ class Residual(Module):
         if tuple_output:
             out, *rest = out
 
-        out = self.l2norm(out)
-        out = self.l2norm(residual.lerp(out, self.branch_scale()))
+        # lerp in place into the freshly normalized branch output when there is no autograd, saving an allocation per residual
+
+        inplace = not torch.is_grad_enabled()
+
+        if self.fused:
+            out = lerp_l2norm(out, residual, self.branch_scale(), inplace = inplace)
+        else:
+            out = self.l2norm(out).type_as(residual)
+            out = torch.lerp(residual, out, self.branch_scale(), out = out) if inplace else residual.lerp(out, self.branch_scale())
+            out = self.l2norm(out)
 
         if tuple_output:
             out = (out, *rest)
@@ -162,6 +268,10 @@ class NormLinear(Module):
                 self.l2norm
             )
 
+        # normalized weight snapshot for inference, set by cache_weight_()
+
+        self.register_buffer('cached_weight', None, persistent = False)
+
         self.norm_weights_()
 
     def __eq__(self, x):
@@ -181,12 +291,39 @@ class NormLinear(Module):
         else:
             self.weight.copy_(self.l2norm(self.weight))
 
+    @torch.no_grad()
+    def cache_weight_(self):
+        # parametrized weights are otherwise renormalized on every forward, manual norm weights are already stored normalized
+
+        if not self.parametrize:
+            return
+
+        self.cached_weight = self.weight
+
+    def clear_cached_weight_(self):
+        self.cached_weight = None
+
     @property
     def weight(self):
         return self.linear.weight
 
-    def forward(self, x):
-        return self.linear(x) * self.scale
+    @property
+    def normed_weight(self):
+        if exists(self.cached_weight):
+            return self.cached_weight
+
+        return self.weight
+
+    def forward(self, x, out_scale = None):
+        weight = self.normed_weight
+
+        if not exists(out_scale):
+            return F.linear(x, weight) * self.scale
+
+        # a per output feature scale is folded into the (dim_out, dim) weight, which is much smaller than the (..., dim_out) output it would otherwise be applied to
+
+        weight = weight * rearrange(out_scale * self.scale, 'o -> o 1')
+        return F.linear(x, weight)
 
 # attention
 
@@ -225,10 +362,13 @@ class Attention(Module):
         self.dim_sqrt = dim_sqrt
         self.attn_scale = dim_head ** 0.5
 
+        # queries, keys, values packed into one projection - each row is normalized independently, so this is the same as three separate ones
+
         dim_inner = dim_head * heads
-        self.to_q = NormLinear_(dim, dim_inner)
-        self.to_k = NormLinear_(dim, dim_inner)
-        self.to_v = NormLinear_(dim, dim_inner)
+        self.dim_inner = dim_inner
+        self.to_qkv = NormLinear_(dim, dim_inner * 3)
+
+        self._register_load_state_dict_pre_hook(self.load_legacy_qkv_hook)
 
         # flash attention related context manager
 
@@ -239,71 +379,109 @@ class Attention(Module):
 
         self.norm_qk = norm_qk
         self.qk_scale = Scale(dim_inner, s_qk_init, default(s_qk_scale, dim ** -1))
-
-        self.split_heads = Rearrange('b n (h d) -> b h n d', h = heads)
-        self.merge_heads = Rearrange('b h n d -> b n (h d)')
+        self.qk_scale_shape = (heads, 1, dim_head)
 
         self.to_out = NormLinear_(dim_inner, dim, norm_dim_in = False)
 
     def __eq__(x, y):
         return x.dim == y.dim and x.heads == y.heads and x.dim_head == y.dim_head
 
+    def load_legacy_qkv_hook(self, state_dict, prefix, *args):
+        # checkpoints from before the packed projection have separate to_q, to_k, to_v weights - concatenate them into to_qkv along the output dimension
+
+        for weight_key in ('linear.parametrizations.weight.original', 'linear.weight'):
+            keys = [f'{prefix}to_{name}.{weight_key}' for name in ('q', 'k', 'v')]
+
+            if not all(key in state_dict for key in keys):
+                continue
+
+            state_dict[f'{prefix}to_qkv.{weight_key}'] = torch.cat([state_dict.pop(key) for key in keys], dim = 0)
+
     def forward(
         self,
         x,
         mask = None,
         rotary_embed: Module | None = None,
         value_residual = None,
-        return_values = False
+        return_values = False,
+        attn_mask = None,
+        row_all_masked_out = None,
+        rotary_freqs = None
     ):
-        q, k, v = self.to_q(x), self.to_k(x), self.to_v(x)
+        batch, seq_len = x.shape[:2]
+
+        qkv = self.to_qkv(x)
 
-        # split heads
+        # split heads, keeping queries and keys packed - (b, n, (qkv h d)) -> (qkv, b, h, n, d)
 
-        q, k, v = map(self.split_heads, (q, k, v))
+        qkv = qkv.view(batch, seq_len, 3, self.heads, self.dim_head).permute(2, 0, 3, 1, 4)
+
+        # values copied out of the packed projection, so that what sdpa saves for backward (and the kept first layer values) does not hold on to the whole packed storage
+
+        qk, v = qkv[:2], qkv[2].contiguous()
 
         # maybe value residual, from resformer paper
 
         if exists(value_residual):
             v = 0.5 * (v + value_residual)
 
-        # rotary positions
+        # rotary positions - queries and keys rotated together in one call
+        # frequencies can be passed in precomputed, so they are built once across all layers
+
+        if exists(rotary_freqs):
+            qk = apply_rotary_emb(rotary_freqs, qk)
+        elif exists(rotary_embed):
+            qk = rotary_embed.rotate_queries_or_keys(qk)
+
+        q, k = qk
 
-        if exists(rotary_embed):
-            q = rotary_embed.rotate_queries_or_keys(q)
-            k = rotary_embed.rotate_queries_or_keys(k)
+        # scaling queries and keys - this would line up with the popular use of qk rmsnorm from google deepmind and now black forest labs - will use multihead rmsnorm
+
+        qk_scale = self.qk_scale(self.qk_scale_shape)
 
         # maybe query key norm
 
         if self.norm_qk:
             q, k = map(self.l2norm, (q, k))
 
-        # scaling queries and keys - this would line up with the popular use of qk rmsnorm from google deepmind and now black forest labs - will use multihead rmsnorm
+        # without autograd, the normalized queries are a fresh tensor that can take the scale in place, saving a query sized allocation
+        # with autograd the qk scale needs the unscaled queries saved for its gradient, so in place would only move the allocation
 
-        q = q * rearrange(self.qk_scale(), '(h d) -> h 1 d', h = self.heads)
+        if self.norm_qk and not torch.is_grad_enabled():
+            q = q.mul_(qk_scale)
+        else:
+            q = q * qk_scale
 
         # for non-autoregressive masking
+        # the sdpa mask and the fully masked rows can be passed in precomputed, so they are built once across all layers
 
-        if exists(mask):
-            row_all_masked_out = ~mask.any(dim = -1)
+        if exists(mask) and not exists(attn_mask):
+            attn_mask = build_attn_mask(mask, causal = self.causal)
 
-            mask = rearrange(mask, 'b j -> b 1 1 j')
+        if exists(attn_mask) and not exists(row_all_masked_out):
+            row_all_masked_out = get_row_all_masked_out(attn_mask)
+
+        # only pass is_causal when there is no mask, which keeps the unmasked causal case on the flash kernel
+
+        is_causal = self.causal and not exists(attn_mask)
 
         # scale is sqrt(dk)
 
         with self.sdpa_context_manager():
             out = F.scaled_dot_product_attention(
                 q, k, v,
-                attn_mask = mask,
-                is_causal = self.causal,
+                attn_mask = attn_mask,
+                is_causal = is_causal,
                 scale = self.attn_scale
             )
 
-        out = self.merge_heads(out)
+        # merge heads - (b, h, n, d) -> (b, n, (h d))
+
+        out = out.transpose(1, 2).reshape(batch, seq_len, -1)
         out = self.to_out(out)
 
-        if exists(mask) and row_all_masked_out.any():
-            out = out.masked_fill(row_all_masked_out[:, None, None], 0.)
+        if exists(row_all_masked_out):
+            out = out.masked_fill(row_all_masked_out, 0.)
 
         if not return_values:
             return out
@@ -340,7 +518,10 @@ class FeedForward(Module):
         self.to_gate = NormLinear_(dim, dim_inner)
 
         self.hidden_scale = Scale(dim_inner, s_hidden_init, s_hidden_scale)
-        self.gate_scale = Scale(dim_inner, s_gate_init, s_gate_scale)
+
+        # the sqrt(dim) on the gate is folded into the forward scale, leaving the learned parameter and its effective learning rate untouched
+
+        self.gate_scale = Scale(dim_inner, s_gate_init * (dim ** 0.5), s_gate_scale)
 
         self.to_out = NormLinear_(dim_inner, dim, norm_dim_in = False)
 
@@ -348,10 +529,10 @@ class FeedForward(Module):
         return x.dim == y.dim and x.expand_factor == y.expand_factor
 
     def forward(self, x):
-        hidden, gate = self.to_hidden(x), self.to_gate(x)
+        # hidden and gate scales folded into the projection weights, leaving only the silu and product over the full hidden activations
 
-        hidden = hidden * self.hidden_scale()
-        gate = gate * self.gate_scale() * (self.dim ** 0.5)
+        hidden = self.to_hidden(x, out_scale = self.hidden_scale())
+        gate = self.to_gate(x, out_scale = self.gate_scale())
 
         hidden = F.silu(gate) * hidden
         return self.to_out(hidden)
@@ -394,7 +575,8 @@ class nGPT(Module):
             enable_math = True,
             enable_mem_efficient = True
         ),
-        norm_eps = 0. # greater than 0 allows the norm to be around (1. - norm_eps) to (1. + norm_eps)
+        norm_eps = 0., # greater than 0 allows the norm to be around (1. - norm_eps) to (1. + norm_eps)
+        bf16_autocast = False # run the forward under bfloat16 autocast, l2norms are still reduced in float32
     ):
         super().__init__()
         NormLinear_ = partial(NormLinear, parametrize = not manual_norm_weights, norm_eps = norm_eps, groups = num_hyperspheres)
@@ -494,6 +676,15 @@ class nGPT(Module):
 
         self.ignore_index = ce_ignore_index
 
+        self.bf16_autocast = bf16_autocast
+
+        # int8 logit projection for inference, set by inference_()
+
+        self.register_buffer('logits_weight_int8', None, persistent = False)
+        self.register_buffer('logits_weight_scale', None, persistent = False)
+
+        self._register_load_state_dict_pre_hook(self.clear_inference_hook)
+
     def __eq__(self, other):
         return (
             isinstance(other, nGPT) and
@@ -505,13 +696,95 @@ class nGPT(Module):
             self.ff_expand_factor == other.ff_expand_factor
         )
 
+    def clear_inference_(self):
+        self.logits_weight_int8 = self.logits_weight_scale = None
+
+        for module in self.modules():
+            if isinstance(module, NormLinear):
+                module.clear_cached_weight_()
+
+    def clear_inference_hook(self, *args):
+        # loading new weights makes the inference snapshots stale
+
+        self.clear_inference_()
+
+    def train(self, mode = True):
+        # the inference snapshots would go stale once training resumes
+
+        if mode:
+            self.clear_inference_()
+
+        return super().train(mode)
+
     @torch.no_grad()
     def norm_weights_(self):
+        # weights are about to change, so drop any inference snapshots
+
+        self.clear_inference_()
+
+        # weights sharing a norm are divided in place by their per row norms with one foreach division, rather than normalized and copied back per module
+
+        grouped_weights = defaultdict(list)
+
         for module in self.modules():
             if not isinstance(module, NormLinear):
                 continue
 
-            module.norm_weights_()
+            weight = module.linear.parametrizations.weight.original if module.parametrize else module.weight
+            norm = module.l2norm
+
+            grouped_weights[(weight.dtype, weight.device, norm.dim, norm.norm_eps, norm.groups)].append(weight)
+
+        for (dtype, _, dim, norm_eps, groups), weights in grouped_weights.items():
+
+            # views split into hyperspheres, so the division writes straight into the weights
+
+            dim = dim % 2
+            weights = [weight.unflatten(dim, (groups, -1)) for weight in weights]
+
+            norms = [torch.linalg.vector_norm(weight, dim = dim + 1, keepdim = True, dtype = torch.promote_types(dtype, torch.float32)) for weight in weights]
+
+            # same divisors as l2norm
+
+            if norm_eps == 0.:
+                divisors = torch._foreach_clamp_min(norms, 1e-12)
+            else:
+                eps = 1e-5 if dtype == torch.float16 else 1e-10
+                divisors = [(norm / norm.clamp(min = 1. - norm_eps, max = 1. + norm_eps)).clamp(min = eps) for norm in norms]
+
+            torch._foreach_div_(weights, divisors)
+
+    @torch.no_grad()
+    def inference_(
+        self,
+        cache_norm_weights = True,
+        quantize_logits = True
+    ):
+        # snapshots the normalized weights, so parametrized weights are not renormalized on every forward
+        # and the logit projection to int8 with a per row scale, which loses little as every row lies on the unit sphere
+        # cleared on train(), norm_weights_() and load_state_dict(), and must be called again whenever the weights are changed any other way
+
+        self.eval()
+        self.clear_inference_()
+
+        if cache_norm_weights:
+            for module in self.modules():
+                if isinstance(module, NormLinear):
+                    module.cache_weight_()
+
+        if not quantize_logits:
+            return self
+
+        if exists(self.to_logits):
+            weight = self.to_logits.weight * self.to_logits.scale
+        else:
+            weight = self.token_embed.weight
+
+        weight_int8, weight_scale = quantize_int8(weight)
+
+        self.logits_weight_int8 = weight_int8
+        self.logits_weight_scale = rearrange(weight_scale, 'c 1 -> c')
+        return self
 
     def register_step_post_hook(self, optimizer):
         assert hasattr(optimizer, 'register_step_post_hook')
@@ -528,40 +801,77 @@ class nGPT(Module):
         return_loss = False,
         return_hiddens = False
     ):
-        token_embed, rotary_embed = self.token_embed.weight, self.rotary_embed
+        token_embed, rotary_embed = self.token_embed.normed_weight, self.rotary_embed
 
         if return_loss:
             assert self.causal
             ids, labels = ids[:, :-1], ids[:, 1:]
 
-        tokens = token_embed[ids]
+        # maybe bfloat16 autocast for all the matmuls and attention
 
-        hiddens = [tokens]
+        autocast_context = partial(torch.autocast, device_type = ids.device.type, dtype = torch.bfloat16) if self.bf16_autocast else nullcontext
 
-        first_values = None
+        with autocast_context():
+            tokens = token_embed[ids]
 
-        for attn, ff in self.layers:
-            tokens, values = attn(tokens, mask = mask, rotary_embed = rotary_embed, return_values = True, value_residual = first_values if self.add_value_residual else None)
+            # maybe hiddens, written into one preallocated buffer rather than stacked at the end
 
-            hiddens.append(tokens)
-            first_values = default(first_values, values)
+            hiddens = None
 
-            tokens = ff(tokens)
+            if return_hiddens:
+                hiddens = tokens.new_empty((self.depth * 2 + 1, *tokens.shape))
+                hiddens[0].copy_(tokens)
 
-            hiddens.append(tokens)
+            # rotary frequencies, computed once for all layers
 
-        if exists(self.to_logits):
-            logits = self.to_logits(tokens)
-        else:
-            # tied embeddings
-            logits = einsum(tokens, token_embed, 'b n d, c d -> b n c')
+            seq_len = tokens.shape[-2]
+            rotary_pos = rotary_embed.get_seq_pos(seq_len, device = tokens.device, dtype = torch.float32)
+            rotary_freqs = rotary_embed(rotary_pos, seq_len = seq_len)
+
+            # attention mask, with causal folded in, and rows where every key is masked out - built once for all layers
+
+            attn_mask = row_all_masked_out = None
+
+            if exists(mask):
+                attn_mask = build_attn_mask(mask, causal = self.causal)
+                row_all_masked_out = get_row_all_masked_out(attn_mask)
+
+            first_values = None
+
+            for ind, (attn, ff) in enumerate(self.layers):
+
+                # only the first layer's values are held on to, and only if used for the value residual
+
+                return_values = self.add_value_residual and not exists(first_values)
+
+                attn_out = attn(tokens, rotary_freqs = rotary_freqs, return_values = return_values, value_residual = first_values, attn_mask = attn_mask, row_all_masked_out = row_all_masked_out)
+
+                if return_values:
+                    tokens, first_values = attn_out
+                else:
+                    tokens = attn_out
+
+                if return_hiddens:
+                    hiddens[ind * 2 + 1].copy_(tokens)
+
+                tokens = ff(tokens)
+
+                if return_hiddens:
+                    hiddens[ind * 2 + 2].copy_(tokens)
+
+            # logit scale folded into the projection weight, so the full logits are never rescaled
 
-        logits = logits * self.logit_scale()
+            logit_scale = self.logit_scale()
 
-        # maybe return hiddens
+            # int8 logits only where torch._int_mm can run, otherwise the usual projection
 
-        if return_hiddens:
-            hiddens = stack(hiddens)
+            if exists(self.logits_weight_int8) and not self.training and int_mm_supported(tokens, self.logits_weight_int8):
+                logits = int8_linear(tokens, self.logits_weight_int8, self.logits_weight_scale * logit_scale)
+            elif exists(self.to_logits):
+                logits = self.to_logits(tokens, out_scale = logit_scale)
+            else:
+                # tied embeddings
+                logits = F.linear(tokens, token_embed * rearrange(logit_scale, 'c -> c 1'))
 
         # maybe loss
 
@@ -575,7 +885,7 @@ class nGPT(Module):
         # autoregressive loss
 
         loss = F.cross_entropy(
-            rearrange(logits, 'b n c -> b c n'),
+            rearrange(logits.float(), 'b n c -> b c n'),
             labels,
             ignore_index = self.ignore_index
         )
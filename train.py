@@ -28,6 +28,7 @@ SEQ_LEN = 512
 
 USE_AMP = True
 USE_PARAMETRIZE = True # whether to manually update weights after each optimizer step
+USE_COMPILE = False # compile the training forward into a static graph - sequence length is fixed during training, so no recompiles
 
 device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
 
@@ -104,6 +105,10 @@ model = nGPT(
     manual_norm_weights = not USE_PARAMETRIZE
 ).to(device)
 
+# compiled model for training and validation, sampling stays on the eager model as its sequence length changes every step
+
+train_model = torch.compile(model, dynamic = False) if USE_COMPILE else model
+
 scaler = GradScaler(enabled = USE_AMP)
 
 # prepare enwik8 data
@@ -153,7 +158,7 @@ for i in tqdm.tqdm(range(NUM_BATCHES), mininterval = 10.0, desc = "training"):
         data = next(train_loader)
 
         with torch.autocast(device_type = 'cuda',  dtype = torch.float16, enabled = USE_AMP):
-            loss = model(data, return_loss = True)
+            loss = train_model(data, return_loss = True)
 
         scaler.scale(loss / GRAD_ACCUM_EVERY).backward()
 
@@ -169,7 +174,7 @@ for i in tqdm.tqdm(range(NUM_BATCHES), mininterval = 10.0, desc = "training"):
         with torch.no_grad():
             valid_data = next(val_loader)
 
-            loss = model(valid_data, return_loss = True)
+            loss = train_model(valid_data, return_loss = True)
             print(f"validation loss: {loss.item():.3f}")
 
     if i % GENERATE_EVERY == 0: